@@ -1,6 +1,9 @@
 
-from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory, abort
+from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory, abort, g, session, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, select, update, insert, delete, bindparam
+from sqlalchemy.exc import OperationalError, IntegrityError
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
@@ -8,8 +11,10 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField, TextAreaField, DecimalField, SelectField
 from wtforms.validators import DataRequired, Length, Email, NumberRange
 from PIL import Image, UnidentifiedImageError
-import os, uuid
-import os
+import os, uuid, random, time, re, zlib, threading, atexit, unicodedata
+from collections import Counter
+from functools import wraps
+import numpy as np
 
 ALLOWED_EXTENSIONS = {'png','jpg','jpeg','gif'}
 
@@ -25,12 +30,55 @@ if uri.startswith("postgres://"):
 
 app.config['SQLALCHEMY_DATABASE_URI'] = uri
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+# Réplicas en lecture seule (facultatif) : URLs séparées par des virgules
+replica_uris = [r.strip() for r in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if r.strip()]
+replica_uris = [r.replace("postgres://", "postgresql://", 1) if r.startswith("postgres://") else r for r in replica_uris]
+app.config['SQLALCHEMY_BINDS'] = {f'replica_{i}': r for i, r in enumerate(replica_uris)}
+app.config['REPLICA_BIND_KEYS'] = list(app.config['SQLALCHEMY_BINDS'])
+# Après une écriture, l'utilisateur lit sur le primaire pendant ce délai (lag de réplication)
+app.config['REPLICA_STICKY_SECONDS'] = int(os.environ.get('REPLICA_STICKY_SECONDS', 10))
 app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path,'static','uploads')
 app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-db = SQLAlchemy(app)
+class RoutingSession(Session):
+    """Envoie les lectures des routes @read_replica vers une réplica, le reste vers le primaire."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        replica = g.get('db_replica') if bind is None else None
+        if replica and not self._flushing:
+            return self._db.engines[replica]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+@event.listens_for(RoutingSession, 'after_flush')
+def stick_to_primary(sess, flush_context):
+    # read-your-writes : l'auteur d'une écriture relit sur le primaire quelques secondes
+    if app.config['REPLICA_BIND_KEYS'] and has_request_context():
+        session['db_primary_until'] = time.time() + app.config['REPLICA_STICKY_SECONDS']
+
+def read_replica(view):
+    """Route en lecture seule : ses requêtes SQL partent sur une réplica si possible.
+
+    Si la réplica est injoignable, la vue est rejouée une fois sur le primaire.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        keys = app.config['REPLICA_BIND_KEYS']
+        if not keys or session.get('db_primary_until', 0) >= time.time():
+            return view(*args, **kwargs)
+        g.db_replica = random.choice(keys)
+        try:
+            return view(*args, **kwargs)
+        except OperationalError:
+            app.logger.warning('Réplica %s injoignable, lecture sur le primaire', g.db_replica, exc_info=True)
+            db.session.rollback()
+            g.pop('db_replica', None)
+            return view(*args, **kwargs)
+    return wrapper
+
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 with app.app_context():
     db.create_all()
 login_manager = LoginManager(app)
@@ -59,6 +107,22 @@ class Item(db.Model):
     owner_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     available = db.Column(db.Boolean, default=True)
 
+class ItemSignature(db.Model):
+    item_id = db.Column(db.Integer, db.ForeignKey('item.id'), primary_key=True)
+    owner_id = db.Column(db.Integer, index=True)
+    image_hash = db.Column(db.BigInteger, nullable=True)
+    minhash = db.Column(db.LargeBinary, nullable=True)
+
+class ItemStats(db.Model):
+    item_id = db.Column(db.Integer, db.ForeignKey('item.id'), primary_key=True)
+    views = db.Column(db.Integer, nullable=False, default=0, index=True)
+
+class Recommendation(db.Model):
+    # item_id = 0 : liste globale des annonces populaires
+    item_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    rank = db.Column(db.SmallInteger, primary_key=True, autoincrement=False)
+    recommended_id = db.Column(db.Integer, db.ForeignKey('item.id'), nullable=False)
+
 class RegisterForm(FlaskForm):
     name = StringField('Nom', validators=[DataRequired(), Length(min=2)])
     email = StringField('Email', validators=[DataRequired(), Email()])
@@ -88,7 +152,247 @@ def load_user(user_id):
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.',1)[1].lower() in ALLOWED_EXTENSIONS
 
+# --- Détection des doublons (même vendeur, annonce quasi identique) ---
+MINHASH_PERM = 64
+MINHASH_BANDS = 16  # 16 bandes de 4 lignes : candidats à partir de ~50% de similarité
+MINHASH_PRIME = (1 << 31) - 1
+DUPLICATE_TEXT_SIM = 0.8
+# Photo quasi identique : suffit si le texte est au moins moyennement proche
+DUPLICATE_IMAGE_BITS = 5
+DUPLICATE_IMAGE_TEXT_SIM = 0.5
+DHASH_MIN_BITS = 8  # photo unie ou peu texturée : dHash proche de 0, inutilisable
+# Avec plusieurs workers, les ids ne sont pas forcément commités dans l'ordre :
+# chaque synchro relit cette fenêtre sous le dernier id chargé.
+SIGNATURE_SYNC_WINDOW = 200
+_perm_rng = np.random.RandomState(20240601)
+_perm_a = _perm_rng.randint(1, MINHASH_PRIME, MINHASH_PERM).astype(np.uint64)
+_perm_b = _perm_rng.randint(0, MINHASH_PRIME, MINHASH_PERM).astype(np.uint64)
+
+def text_minhash(*parts):
+    """Signature MinHash des 4-grammes du texte, ou None s'il ne reste aucun caractère utile."""
+    # accents retirés : « Très bon état » et « Tres bon etat » donnent les mêmes 4-grammes
+    text = unicodedata.normalize('NFKD', ' '.join(p or '' for p in parts))
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r'\W+', ' ', text.lower()).strip()
+    if not text:
+        return None
+    shingles = {text[i:i+4] for i in range(max(len(text) - 3, 1))}
+    x = np.array([zlib.crc32(s.encode()) for s in shingles], dtype=np.uint64) % MINHASH_PRIME
+    hashes = (np.outer(x, _perm_a) + _perm_b) % MINHASH_PRIME
+    return hashes.min(axis=0).astype(np.uint32)
+
+def image_dhash(img):
+    # dHash 64 bits : gradient horizontal d'une vignette 9x8 en niveaux de gris
+    px = np.asarray(img.convert('L').resize((9, 8)), dtype=np.int16)
+    bits = np.packbits((px[:, 1:] > px[:, :-1]).flatten())
+    return int(np.frombuffer(bits.tobytes(), dtype='>i8')[0])
+
+def _band_keys(sigs):
+    rows = sigs.reshape(len(sigs), MINHASH_BANDS, -1).astype(np.uint64)
+    keys = np.zeros(rows.shape[:2], dtype=np.uint64)
+    for i in range(rows.shape[2]):
+        keys = keys * np.uint64(1000003) + rows[:, :, i]
+    return keys
+
+class SignatureIndex:
+    """Signatures du catalogue en tableaux NumPy, synchronisées de façon incrémentale depuis ItemSignature.
+
+    Partagée entre les threads du worker : `lock` protège la synchro et la lecture des tableaux.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.last_id = 0
+        self.loaded = set()
+        self.item_ids = np.zeros(0, dtype=np.int64)
+        self.owners = np.zeros(0, dtype=np.int64)
+        self.image_hashes = np.zeros(0, dtype=np.int64)
+        self.has_image = np.zeros(0, dtype=bool)
+        self.has_text = np.zeros(0, dtype=bool)
+        self.minhashes = np.zeros((0, MINHASH_PERM), dtype=np.uint32)
+        self.bands = np.zeros((0, MINHASH_BANDS), dtype=np.uint64)
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def _sync(self):
+        rows = (ItemSignature.query.filter(ItemSignature.item_id > self.last_id - SIGNATURE_SYNC_WINDOW)
+                .order_by(ItemSignature.item_id).all())
+        rows = [r for r in rows if r.item_id not in self.loaded]
+        if not rows:
+            return
+        self.loaded.update(r.item_id for r in rows)
+        sigs = np.stack([np.frombuffer(r.minhash, dtype=np.uint32) if r.minhash else np.zeros(MINHASH_PERM, dtype=np.uint32)
+                         for r in rows])
+        self.item_ids = np.concatenate([self.item_ids, [r.item_id for r in rows]])
+        self.owners = np.concatenate([self.owners, [r.owner_id or 0 for r in rows]])
+        self.image_hashes = np.concatenate([self.image_hashes, [r.image_hash or 0 for r in rows]])
+        self.has_image = np.concatenate([self.has_image, [r.image_hash is not None for r in rows]])
+        self.has_text = np.concatenate([self.has_text, [r.minhash is not None for r in rows]])
+        self.minhashes = np.concatenate([self.minhashes, sigs])
+        self.bands = np.concatenate([self.bands, _band_keys(sigs)])
+        self.last_id = max(self.last_id, rows[-1].item_id)
+
+    def find_duplicate(self, owner_id, minhash, image_hash=None):
+        """Renvoie l'id d'une annonce quasi identique du même vendeur, ou None."""
+        if minhash is None:
+            return None
+        with self.lock:
+            self._sync()
+            return self._find_duplicate(owner_id, minhash, image_hash)
+
+    def _find_duplicate(self, owner_id, minhash, image_hash):
+        mine = (self.owners == owner_id) & self.has_text
+        # LSH : candidats = au moins une bande identique ; Jaccard estimé seulement sur eux
+        candidates = mine & (self.bands == _band_keys(minhash[None, :])).any(axis=1)
+        sims = np.zeros(len(self.item_ids), dtype=np.float32)
+        sims[candidates] = (self.minhashes[candidates] == minhash).mean(axis=1)
+        dup = sims >= DUPLICATE_TEXT_SIM
+        if image_hash is not None and DHASH_MIN_BITS <= bin(image_hash & (2**64 - 1)).count('1') <= 64 - DHASH_MIN_BITS:
+            with_img = candidates & self.has_image
+            xor = (self.image_hashes[with_img] ^ np.int64(image_hash)).view(np.uint8)
+            same_photo = np.unpackbits(xor).reshape(-1, 64).sum(axis=1) <= DUPLICATE_IMAGE_BITS
+            dup[with_img] |= same_photo & (sims[with_img] >= DUPLICATE_IMAGE_TEXT_SIM)
+        hits = self.item_ids[dup]
+        return int(hits[0]) if len(hits) else None
+
+signature_index = SignatureIndex()
+
+# --- Compteur de vues : tamponné en mémoire, écrit par lots ---
+VIEW_FLUSH_SIZE = 50
+VIEW_FLUSH_SECONDS = 30
+_view_buffer = Counter()
+_view_lock = threading.Lock()
+_view_pending = 0
+_view_flushed_at = time.time()
+_view_flushing = False
+
+def count_view(item_id):
+    """Compte une vue ; l'écriture par lot part dans un thread, jamais dans la requête."""
+    global _view_pending, _view_flushing
+    with _view_lock:
+        _view_buffer[item_id] += 1
+        _view_pending += 1
+        due = _view_pending >= VIEW_FLUSH_SIZE or time.time() - _view_flushed_at >= VIEW_FLUSH_SECONDS
+        start = due and not _view_flushing
+        if start:
+            _view_flushing = True
+    if start:
+        threading.Thread(target=_flush_views_in_background, daemon=True).start()
+
+def _flush_views_in_background():
+    global _view_flushing
+    try:
+        with app.app_context():
+            flush_views()
+    finally:
+        with _view_lock:
+            _view_flushing = False
+
+def flush_views():
+    """Écrit les vues en attente en une seule transaction, toujours sur le primaire.
+
+    Si la base est injoignable, les vues sont remises dans le tampon pour le prochain lot ;
+    toute autre erreur (contrainte, id invalide...) abandonne le lot pour ne pas bloquer les suivants.
+    """
+    global _view_pending, _view_flushed_at
+    with _view_lock:
+        pending = [{'iid': k, 'n': v} for k, v in _view_buffer.items()]
+        _view_buffer.clear()
+        _view_pending = 0
+        _view_flushed_at = time.time()
+    if not pending:
+        return
+    try:
+        try:
+            _write_views(pending)
+        except IntegrityError:
+            # un autre worker a pu créer les mêmes lignes ItemStats entre-temps : un seul nouvel essai
+            _write_views(pending)
+    except OperationalError:
+        app.logger.exception('Base injoignable, vues remises en attente pour le prochain lot')
+        with _view_lock:
+            _view_buffer.update({p['iid']: p['n'] for p in pending})
+            _view_pending += sum(p['n'] for p in pending)
+    except Exception:
+        app.logger.exception('Échec de l\'écriture des vues, lot abandonné (%d annonces)', len(pending))
+
+def _write_views(pending):
+    ids = [p['iid'] for p in pending]
+    stmt = update(ItemStats).where(ItemStats.item_id == bindparam('iid')).values(views=ItemStats.views + bindparam('n'))
+    with db.engine.begin() as conn:
+        # upsert : crée d'abord les lignes manquantes (annonces antérieures ou indisponibles)
+        known = set(conn.execute(select(ItemStats.item_id).where(ItemStats.item_id.in_(ids))).scalars())
+        missing = [{'item_id': i, 'views': 0} for i in ids if i not in known]
+        if missing:
+            conn.execute(insert(ItemStats), missing)
+        conn.execute(stmt, pending)
+
+@atexit.register
+def _flush_views_at_exit():
+    with app.app_context():
+        flush_views()
+
+# --- Recommandations précalculées (TF-IDF) ---
+SIMILAR_COUNT = 4
+POPULAR_COUNT = 4
+TFIDF_MAX_FEATURES = 2048
+TFIDF_BATCH = 512
+
+def tfidf_matrix(docs):
+    """Matrice TF-IDF (float32, lignes normalisées L2) limitée aux termes les plus fréquents."""
+    tokens = [re.findall(r'\w{2,}', d.lower()) for d in docs]
+    df = Counter(t for toks in tokens for t in set(toks))
+    vocab = {t: i for i, (t, _) in enumerate(df.most_common(TFIDF_MAX_FEATURES))}
+    rows = [r for r, toks in enumerate(tokens) for t in toks if t in vocab]
+    cols = [vocab[t] for toks in tokens for t in toks if t in vocab]
+    X = np.zeros((len(docs), len(vocab)), dtype=np.float32)
+    np.add.at(X, (np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp)), 1)
+    dfs = np.array([df[t] for t in vocab], dtype=np.float32)
+    X *= np.log((1 + len(docs)) / (1 + dfs)) + 1
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    return X / np.where(norms == 0, 1, norms)
+
+def similar_items(X, k):
+    """Pour chaque ligne, indices des k lignes les plus proches (cosinus > 0), calculés par lots."""
+    k = min(k, len(X) - 1)
+    result = []
+    for start in range(0, len(X), TFIDF_BATCH):
+        sims = X[start:start+TFIDF_BATCH] @ X.T
+        sims[np.arange(len(sims)), start + np.arange(len(sims))] = -1
+        if k <= 0:
+            result.extend([] for _ in sims)
+            continue
+        top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        top_sims = np.take_along_axis(sims, top, axis=1)
+        order = np.argsort(-top_sims, axis=1)
+        top, top_sims = np.take_along_axis(top, order, axis=1), np.take_along_axis(top_sims, order, axis=1)
+        result.extend(t[s > 0].tolist() for t, s in zip(top, top_sims))
+    return result
+
+def compute_recommendations():
+    flush_views()
+    items = Item.query.filter(Item.available.isnot(False)).order_by(Item.id).all()
+    known = {iid for (iid,) in db.session.query(ItemStats.item_id)}
+    db.session.add_all(ItemStats(item_id=i.id, views=0) for i in items if i.id not in known)
+    rows = []
+    if items:
+        X = tfidf_matrix([' '.join(filter(None, (i.title, i.description, i.condition))) for i in items])
+        for itm, neighbours in zip(items, similar_items(X, SIMILAR_COUNT)):
+            rows += [{'item_id': itm.id, 'rank': r, 'recommended_id': items[j].id} for r, j in enumerate(neighbours)]
+    popular = (db.session.query(ItemStats.item_id).join(Item, Item.id == ItemStats.item_id)
+               .filter(Item.available.isnot(False)).order_by(ItemStats.views.desc())
+               .limit(POPULAR_COUNT + 1).all())
+    rows += [{'item_id': 0, 'rank': r, 'recommended_id': iid} for r, (iid,) in enumerate(popular)]
+    db.session.execute(delete(Recommendation))
+    if rows:
+        db.session.execute(insert(Recommendation), rows)
+    db.session.commit()
+    return len(items)
+
 @app.route('/')
+@read_replica
 def index():
     q = request.args.get('q','')
     filter_type = request.args.get('type','')
@@ -143,6 +447,7 @@ def add_item():
     if form.validate_on_submit():
         f = request.files.get('image')
         filename = None
+        image_hash = None
         if f and f.filename:
             if not allowed_file(f.filename):
                 flash('Format d\'image non accepté', 'danger')
@@ -158,6 +463,7 @@ def add_item():
                 img = Image.open(path)
                 img.thumbnail((1200,1200))
                 img.save(path)
+                image_hash = image_dhash(img)
             except (UnidentifiedImageError, OSError):
                 if os.path.exists(path):
                     os.remove(path)
@@ -168,6 +474,12 @@ def add_item():
         except Exception:
             flash('Prix invalide', 'danger')
             return redirect(request.url)
+        minhash = text_minhash(form.title.data, form.description.data)
+        if signature_index.find_duplicate(current_user.id, minhash, image_hash) is not None:
+            if filename:
+                os.remove(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+            flash('Vous avez déjà publié une annonce presque identique', 'warning')
+            return redirect(request.url)
         itm = Item(
             title=form.title.data,
             description=form.description.data,
@@ -178,17 +490,30 @@ def add_item():
             owner_id=current_user.id
         )
         db.session.add(itm)
+        db.session.flush()
+        db.session.add(ItemSignature(item_id=itm.id, owner_id=itm.owner_id,
+                                     image_hash=image_hash, minhash=minhash.tobytes() if minhash is not None else None))
+        db.session.add(ItemStats(item_id=itm.id, views=0))
         db.session.commit()
         flash('Annonce publiée ✅', 'success')
         return redirect(url_for('index'))
     return render_template('add_item.html', form=form)
 
 @app.route('/item/<int:item_id>')
+@read_replica
 def item_detail(item_id):
     itm = Item.query.get_or_404(item_id)
-    return render_template('item_detail.html', item=itm)
+    count_view(item_id)
+    recs = (db.session.query(Recommendation.item_id, Item)
+            .join(Item, Item.id == Recommendation.recommended_id)
+            .filter(Recommendation.item_id.in_((item_id, 0)))
+            .order_by(Recommendation.item_id.desc(), Recommendation.rank).all())
+    similar = [r for key, r in recs if key == item_id]
+    popular = [r for key, r in recs if key == 0 and r.id != item_id][:POPULAR_COUNT]
+    return render_template('item_detail.html', item=itm, similar=similar, popular=popular)
 
 @app.route('/uploads/<path:filename>')
+@read_replica
 def uploads(filename):
     return send_from_directory(app.config['UPLOAD_FOLDER'], filename, as_attachment=False)
 
@@ -197,6 +522,34 @@ def init_db():
     db.create_all()
     print('Database created')
 
+@app.cli.command('index-signatures')
+def index_signatures():
+    """Calcule les signatures anti-doublons des annonces qui n'en ont pas encore."""
+    done = {sid for (sid,) in db.session.query(ItemSignature.item_id)}
+    count = 0
+    for itm in Item.query.order_by(Item.id):
+        if itm.id in done:
+            continue
+        image_hash = None
+        if itm.image_filename:
+            try:
+                with Image.open(os.path.join(app.config['UPLOAD_FOLDER'], itm.image_filename)) as img:
+                    image_hash = image_dhash(img)
+            except (UnidentifiedImageError, OSError):
+                pass
+        minhash = text_minhash(itm.title, itm.description)
+        db.session.add(ItemSignature(item_id=itm.id, owner_id=itm.owner_id,
+                                     image_hash=image_hash, minhash=minhash.tobytes() if minhash is not None else None))
+        count += 1
+    db.session.commit()
+    print(f'{count} signatures indexed')
+
+@app.cli.command('compute-recommendations')
+def compute_recommendations_command():
+    """À lancer périodiquement (cron) : annonces similaires et populaires."""
+    count = compute_recommendations()
+    print(f'Recommendations computed for {count} items')
+
 from flask import render_template
 
 @app.route("/alt")
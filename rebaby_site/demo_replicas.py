@@ -0,0 +1,45 @@
+"""Démo locale du routage primaire / réplica avec deux bases SQLite.
+
+    python demo_replicas.py
+
+La "réplication" est simulée par une copie du fichier primaire vers la réplica.
+Les bases et les uploads vont dans un dossier temporaire, supprimé à la fin.
+"""
+import os, shutil, tempfile, atexit
+
+workdir = tempfile.mkdtemp(prefix='rebaby-demo-')
+atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+primary_path = os.path.join(workdir, 'demo_primary.db')
+replica_path = os.path.join(workdir, 'demo_replica.db')
+
+os.environ['DATABASE_URL'] = f'sqlite:///{primary_path}'
+os.environ['DATABASE_REPLICA_URLS'] = f'sqlite:///{replica_path}'
+
+from app import app, db
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+def replicate():
+    with app.app_context():
+        db.session.remove()
+        for engine in db.engines.values():
+            engine.dispose()
+    shutil.copyfile(primary_path, replica_path)
+
+replicate()
+
+seller = app.test_client()
+visitor = app.test_client()
+seller.post('/register', data={'name': 'Alice', 'email': 'alice@example.com', 'password': 'secret123'})
+seller.post('/add', data={'title': 'Poussette démo', 'price': '80', 'listing_type': 'sale'})
+
+seen_by_seller = 'Poussette démo' in seller.get('/').get_data(as_text=True)
+seen_by_visitor = 'Poussette démo' in visitor.get('/').get_data(as_text=True)
+print(f"Vendeuse (primaire, read-your-writes) voit l'annonce : {seen_by_seller}")
+print(f"Visiteur (réplica pas encore à jour) voit l'annonce : {seen_by_visitor}")
+
+replicate()
+seen_by_visitor = 'Poussette démo' in visitor.get('/').get_data(as_text=True)
+print(f"Visiteur après réplication voit l'annonce : {seen_by_visitor}")